@@ -1,11 +1,22 @@
 import gradio as gr
+import anyio
+import atexit
+import functools
+import importlib.util
 import os
-import base64
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import httpx
 import requests
-from pathlib import Path
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
 import traceback
+from fastapi import FastAPI
 from mistralai import Mistral, models
 from dotenv import load_dotenv
+from ocr_helpers import (MAX_FILE_SIZE_MB, MIME_TYPES, check_file_size,
+                         file_digest, file_to_data_uri, get_combined_markdown)
 
 # Load environment variables from .env file
 load_dotenv()
@@ -16,103 +27,152 @@ if not api_key:
     raise ValueError(
         "MISTRAL_API_KEY environment variable is not set. Please add it to your .env file.")
 
-# Initialize Mistral client
-client = Mistral(api_key=api_key)
+# Shared HTTP session so URL lookups reuse pooled keep-alive connections
+http_session = requests.Session()
+http_session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+http_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
 
 # Constants
-MAX_FILE_SIZE_MB = 50
+# Threads for blocking calls (API, HEAD, encoding) across all requests
+MAX_THREADS = int(os.getenv("OCR_MAX_THREADS", "16"))
+# Concurrent OCR requests per Gradio event
+CONCURRENCY_LIMIT = int(os.getenv("GRADIO_CONCURRENCY_LIMIT", "8"))
+# Multiplex Mistral API calls over HTTP/2 when the h2 package is installed;
+# set MISTRAL_HTTP2=0 behind proxies that do not support it
+USE_HTTP2 = (os.getenv("MISTRAL_HTTP2", "1") != "0"
+             and importlib.util.find_spec("h2") is not None)
+# Number of OCR results kept for repeated inputs
+OCR_CACHE_SIZE = 64
+# Total size of cached Markdown, in MB (counted as characters, which are
+# almost all ASCII); results larger than this are not cached
+OCR_CACHE_MAX_MB = int(os.getenv("OCR_CACHE_MAX_MB", "256"))
+# Seconds that URL lookups and URL OCR results are reused, since the content
+# behind a URL can change; 0 or less disables URL caching. Uploads are keyed
+# by content and never expire
+URL_CACHE_TTL = int(os.getenv("URL_CACHE_TTL", "600"))
+
+# (expiry time or None, size, OCR result) keyed by input, oldest first
+ocr_cache = OrderedDict()
+# Sum of the sizes of all cached results
+ocr_cache_size = 0
+
+# Deletes uploaded files in the background so responses don't wait on them
+cleanup_pool = ThreadPoolExecutor(
+    max_workers=2, thread_name_prefix="ocr-cleanup")
+atexit.register(cleanup_pool.shutdown)
 
 # Helper Functions
 
 
-def replace_images_in_markdown(markdown_str: str, images_dict: dict) -> str:
-    """Replaces image placeholders in Markdown with base64 data URIs."""
-    for img_name, base64_str in images_dict.items():
-        # Ensure the base64 string is formatted correctly for Markdown image data URI
-        if not base64_str.startswith('data:image'):
-            # Attempt to infer mime type - default to png if unknown
-            mime_type = "image/png"  # Default assumption
-            if img_name.lower().endswith((".jpg", ".jpeg")):
-                mime_type = "image/jpeg"
-            elif img_name.lower().endswith(".gif"):
-                mime_type = "image/gif"
-            # Add more types if necessary
-            base64_str = f"data:{mime_type};base64,{base64_str}"
-
-        markdown_str = markdown_str.replace(
-            f"![{img_name}]({img_name})", f"![{img_name}]({base64_str})")
-    return markdown_str
-
-
-def get_combined_markdown(ocr_response) -> tuple:
-    """Combines Markdown from OCR pages/response, embedding images."""
-    markdowns = []
-    raw_markdowns = []
-    # Check if ocr_response has pages (for multi-page docs like PDF)
-    if hasattr(ocr_response, 'pages') and ocr_response.pages:
-        for page in ocr_response.pages:
-            image_data = {}
-            if hasattr(page, 'images') and page.images:
-                for img in page.images:
-                    # Assumes this is already base64 encoded by Mistral
-                    image_data[img.id] = img.image_base64
-            markdowns.append(replace_images_in_markdown(
-                page.markdown, image_data))
-            raw_markdowns.append(page.markdown)
-    # Check if ocr_response has markdown directly (single images)
-    elif hasattr(ocr_response, 'markdown'):
-        image_data = {}
-        if hasattr(ocr_response, 'images') and ocr_response.images:
-            for img in ocr_response.images:
-                image_data[img.id] = img.image_base64
-        markdowns.append(replace_images_in_markdown(
-            ocr_response.markdown, image_data))
-        raw_markdowns.append(ocr_response.markdown)
-    else:
-        # Handle unexpected response structure
-        print("Warning: Unexpected OCR response structure:", ocr_response)
-        return "## Error: Could not parse OCR response.", ""
-
-    return "\n\n".join(markdowns), "\n\n".join(raw_markdowns)
+@functools.lru_cache(maxsize=None)
+def get_client():
+    """Return the Mistral client, created lazily once per worker process."""
+    # Same as the SDK's default client (httpx.Client(follow_redirects=True)
+    # with httpx's default pool limits), plus HTTP/2 so concurrent calls can
+    # share one multiplexed connection
+    http_client = httpx.Client(http2=USE_HTTP2, follow_redirects=True)
+    return Mistral(api_key=api_key, client=http_client)
 
 
-def get_content_type(url):
-    """Fetch the content type of the URL."""
+@functools.lru_cache(maxsize=None)
+def get_thread_limiter():
+    """Return the limiter for blocking calls, created inside the event loop."""
+    return anyio.CapacityLimiter(MAX_THREADS)
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call in a worker thread, capped at MAX_THREADS at once."""
+    return await anyio.to_thread.run_sync(
+        functools.partial(func, *args, **kwargs), limiter=get_thread_limiter())
+
+
+def delete_uploaded_file(client, file_id):
+    """Delete an uploaded file from Mistral, logging instead of raising on failure."""
     try:
-        response = requests.head(
-            url, allow_redirects=True, timeout=10, stream=True)
-        response.raise_for_status()
-        return response.headers.get('Content-Type')
-    except requests.exceptions.RequestException as e:
-        return f"Error fetching content type: {e}"
+        client.files.delete(file_id=file_id)
     except Exception as e:
-        return f"An unexpected error occurred: {e}"
+        print(f"Warning: Failed cleanup {file_id}: {e}")
+
+
+def get_cached_ocr(key):
+    """Return an unexpired cached OCR result for the input key, or None."""
+    entry = ocr_cache.get(key)
+    if entry is None:
+        return None
+    expires_at, _, result = entry
+    if expires_at is not None and time.monotonic() >= expires_at:
+        discard_cached_ocr(key)
+        return None
+    ocr_cache.move_to_end(key)
+    return result
+
+
+def discard_cached_ocr(key):
+    """Remove a cached OCR result and release its share of the size budget."""
+    global ocr_cache_size
+    ocr_cache_size -= ocr_cache.pop(key)[1]
+
+
+def cache_ocr(key, result, ttl=None):
+    """Cache an OCR result, evicting least recently used ones on overflow."""
+    global ocr_cache_size
+    max_size = OCR_CACHE_MAX_MB * 1024 * 1024
+    size = len(result[0]) + len(result[1])
+    if max_size <= 0 or size > max_size:
+        return
+    if key in ocr_cache:
+        discard_cached_ocr(key)
+    expires_at = time.monotonic() + ttl if ttl is not None else None
+    ocr_cache[key] = (expires_at, size, result)
+    ocr_cache_size += size
+    # Evict from the oldest end until both the count and size limits hold
+    while len(ocr_cache) > OCR_CACHE_SIZE or ocr_cache_size > max_size:
+        discard_cached_ocr(next(iter(ocr_cache)))
+
+
+@functools.lru_cache(maxsize=256)
+def fetch_url_headers(url, ttl_bucket):
+    """Fetch the content type and ETag of the URL, caching successful lookups.
+
+    ttl_bucket only takes part in the cache key, so a lookup is reused until
+    the bucket changes every URL_CACHE_TTL seconds.
+    """
+    response = http_session.head(url, allow_redirects=True, timeout=10)
+    response.raise_for_status()
+    content_type = response.headers.get('Content-Type')
+    if content_type is None:
+        # Raise rather than cache a lookup that can never succeed
+        raise requests.exceptions.InvalidHeader(
+            "Response has no Content-Type header")
+    return content_type, response.headers.get('ETag')
 
 
-def check_file_size(file_path):
-    """Check if file size is within limits."""
+def get_content_type(url):
+    """Fetch the content type and ETag of the URL."""
     try:
-        file_size_mb = Path(file_path).stat().st_size / (1024 * 1024)
-        return file_size_mb <= MAX_FILE_SIZE_MB, file_size_mb
-    except FileNotFoundError:
-        return False, "File not found"
+        if URL_CACHE_TTL <= 0:
+            # URL caching disabled, so always send a fresh HEAD request
+            return fetch_url_headers.__wrapped__(url, None)
+        return fetch_url_headers(url, int(time.monotonic() // URL_CACHE_TTL))
+    except requests.exceptions.RequestException as e:
+        return f"Error fetching content type: {e}", None
     except Exception as e:
-        return False, f"Error checking file size: {e}"
+        return f"Error: An unexpected error occurred: {e}", None
 
 # OCR Functions
 
 
-def perform_ocr_file(file, ocr_method="Mistral OCR"):
+async def perform_ocr_file(file, ocr_method="Mistral OCR", embed_images=True):
     """Performs OCR on an uploaded file using the selected method."""
     if not file:
         return "## Error: No file uploaded.", "No file uploaded."
 
     temp_path = file
     original_filename = getattr(file, 'name', str(temp_path))
-    file_path_obj = Path(original_filename)
-    original_file_suffix = file_path_obj.suffix.lower()
+    original_file_suffix = os.path.splitext(original_filename)[1].lower()
 
     if ocr_method == "Mistral OCR":
+        client = get_client()
         try:
             size_ok, file_size_mb = check_file_size(temp_path)
             if not size_ok:
@@ -121,59 +181,67 @@ def perform_ocr_file(file, ocr_method="Mistral OCR"):
                 else:
                     return f"## Error: File too large ({file_size_mb:.1f}MB). Max is {MAX_FILE_SIZE_MB}MB.", ""
 
+            if original_file_suffix not in ['.pdf', '.png', '.jpg', '.jpeg']:
+                return f"## Error: Unsupported file format ({original_file_suffix}). Please upload PDF, PNG, JPG, JPEG.", ""
+
+            # Identical uploads are answered from the cache
+            cache_key = (await run_blocking(file_digest, temp_path),
+                         original_file_suffix, embed_images)
+            cached_result = get_cached_ocr(cache_key)
+            if cached_result is not None:
+                return cached_result
+
             uploaded_pdf = None
             if original_file_suffix == '.pdf':
                 # Process PDF
                 try:
                     with open(temp_path, "rb") as f:
-                        uploaded_pdf = client.files.upload(
+                        uploaded_pdf = await run_blocking(
+                            client.files.upload,
                             file={"file_name": original_filename, "content": f},
                             purpose="ocr"
                         )
-                    signed_url = client.files.get_signed_url(
-                        file_id=uploaded_pdf.id)
-                    ocr_response = client.ocr.process(
+                    signed_url = await run_blocking(
+                        client.files.get_signed_url, file_id=uploaded_pdf.id)
+                    ocr_response = await run_blocking(
+                        client.ocr.process,
                         model="mistral-ocr-latest",
                         document={"type": "document_url",
                                   "document_url": signed_url.url},
-                        include_image_base64=True
+                        include_image_base64=embed_images
                     )
-                    client.files.delete(file_id=uploaded_pdf.id)
+                    cleanup_pool.submit(
+                        delete_uploaded_file, client, uploaded_pdf.id)
 
                 except models.SDKError as e:
                     if uploaded_pdf:
-                        try:
-                            client.files.delete(file_id=uploaded_pdf.id)
-                        except Exception as cleanup_e:
-                            print(
-                                f"Warning: Failed cleanup {uploaded_pdf.id}: {cleanup_e}")
+                        cleanup_pool.submit(
+                            delete_uploaded_file, client, uploaded_pdf.id)
                     return f"## Mistral API Error: {str(e)}", ""
 
-            elif original_file_suffix in ['.png', '.jpg', '.jpeg']:
+            else:
                 # Process image
                 try:
-                    with open(temp_path, "rb") as image_file:
-                        base64_image = base64.b64encode(
-                            image_file.read()).decode('utf-8')
+                    mime_type = MIME_TYPES.get(original_file_suffix, "image/png")
+                    image_data_uri = await run_blocking(
+                        file_to_data_uri, temp_path, mime_type)
 
-                    mime_type = "image/png"
-                    if original_file_suffix in ['.jpg', '.jpeg']:
-                        mime_type = "image/jpeg"
-
-                    ocr_response = client.ocr.process(
+                    ocr_response = await run_blocking(
+                        client.ocr.process,
                         model="mistral-ocr-latest",
                         document={
-                            "type": "image_url", "image_url": f"data:{mime_type};base64,{base64_image}"},
-                        include_image_base64=True
+                            "type": "image_url", "image_url": image_data_uri},
+                        include_image_base64=embed_images
                     )
                 except models.SDKError as e:
                     return f"## Mistral API Error: {str(e)}", ""
-            else:
-                return f"## Error: Unsupported file format ({original_file_suffix}). Please upload PDF, PNG, JPG, JPEG.", ""
 
-            combined_markdown, raw_markdown = get_combined_markdown(
-                ocr_response)
-            return combined_markdown, raw_markdown
+            markdowns = await run_blocking(
+                get_combined_markdown, ocr_response, embed_images)
+            if markdowns is None:
+                return "## Error: Could not parse OCR response.", ""
+            cache_ocr(cache_key, markdowns)
+            return markdowns
 
         except FileNotFoundError:
             return f"## Error: Temporary file not found: {temp_path}. Gradio issue?", ""
@@ -184,17 +252,24 @@ def perform_ocr_file(file, ocr_method="Mistral OCR"):
     return "## Method not supported.", "Method not supported."
 
 
-def perform_ocr_url(url, ocr_method="Mistral OCR"):
+async def perform_ocr_url(url, ocr_method="Mistral OCR", embed_images=True):
     """Performs OCR on a URL using the selected method."""
     if not url or not url.strip():
         return "## Error: No URL provided.", ""
 
     if ocr_method == "Mistral OCR":
+        client = get_client()
         try:
             if not url.lower().startswith(('http://', 'https://')):
                 return "## Error: Invalid URL scheme. Use http:// or https://.", ""
 
-            content_type_result = get_content_type(url)
+            # Trust an unambiguous suffix and only send a HEAD request otherwise
+            url_suffix = os.path.splitext(urlparse(url).path)[1].lower()
+            content_type_result = MIME_TYPES.get(url_suffix)
+            etag = None
+            if content_type_result is None:
+                content_type_result, etag = await run_blocking(
+                    get_content_type, url)
 
             if isinstance(content_type_result, str) and content_type_result.startswith("Error"):
                 return f"## Error: Could not fetch URL details. {content_type_result}", ""
@@ -203,22 +278,31 @@ def perform_ocr_url(url, ocr_method="Mistral OCR"):
 
             content_type = content_type_result.lower().split(';')[0].strip()
 
+            # Key by URL, plus its ETag when a HEAD lookup ran
+            cache_key = (url, etag, embed_images)
+            cached_result = get_cached_ocr(
+                cache_key) if URL_CACHE_TTL > 0 else None
+            if cached_result is not None:
+                return cached_result
+
             if content_type == 'application/pdf':
                 try:
-                    ocr_response = client.ocr.process(
+                    ocr_response = await run_blocking(
+                        client.ocr.process,
                         model="mistral-ocr-latest",
                         document={"type": "document_url", "document_url": url},
-                        include_image_base64=True
+                        include_image_base64=embed_images
                     )
                 except models.SDKError as e:
                     return f"## Mistral API Error (PDF URL): {str(e)}", ""
 
             elif content_type in ['image/png', 'image/jpeg', 'image/jpg']:
                 try:
-                    ocr_response = client.ocr.process(
+                    ocr_response = await run_blocking(
+                        client.ocr.process,
                         model="mistral-ocr-latest",
                         document={"type": "image_url", "image_url": url},
-                        include_image_base64=True
+                        include_image_base64=embed_images
                     )
                 except models.SDKError as e:
                     return f"## Mistral API Error (Image URL): {str(e)}", ""
@@ -226,9 +310,13 @@ def perform_ocr_url(url, ocr_method="Mistral OCR"):
                 error_msg = f"Unsupported type at URL: '{content_type}'. Use PDF, PNG, JPG, JPEG."
                 return f"## Error: {error_msg}", ""
 
-            combined_markdown, raw_markdown = get_combined_markdown(
-                ocr_response)
-            return combined_markdown, raw_markdown
+            markdowns = await run_blocking(
+                get_combined_markdown, ocr_response, embed_images)
+            if markdowns is None:
+                return "## Error: Could not parse OCR response.", ""
+            if URL_CACHE_TTL > 0:
+                cache_ocr(cache_key, markdowns, ttl=URL_CACHE_TTL)
+            return markdowns
 
         except Exception as e:
             print(f"Unexpected error in perform_ocr_url: {e}")
@@ -251,13 +339,15 @@ with gr.Blocks(css="""
             label=f"Upload PDF or Image (Max {MAX_FILE_SIZE_MB}MB)", type="filepath")
         ocr_method_file = gr.Dropdown(
             choices=["Mistral OCR"], label="Select OCR Method", value="Mistral OCR")
+        embed_images_file = gr.Checkbox(
+            label="Embed images inline", value=True)
         file_output = gr.Markdown(label="Rendered Markdown")
         file_raw_output = gr.Textbox(label="Raw Markdown", lines=10)
         file_button = gr.Button("Process Uploaded File")
 
         file_button.click(
             fn=perform_ocr_file,
-            inputs=[file_input, ocr_method_file],
+            inputs=[file_input, ocr_method_file, embed_images_file],
             outputs=[file_output, file_raw_output]
         )
 
@@ -266,24 +356,34 @@ with gr.Blocks(css="""
                                placeholder="e.g., https://arxiv.org/pdf/1706.03762")
         ocr_method_url = gr.Dropdown(
             choices=["Mistral OCR"], label="Select OCR Method", value="Mistral OCR")
+        embed_images_url = gr.Checkbox(
+            label="Embed images inline", value=True)
         url_output = gr.Markdown(label="Rendered Markdown")
         url_raw_output = gr.Textbox(label="Raw Markdown", lines=10)
         url_button = gr.Button("Process URL")
 
         gr.Examples(
             examples=[
-                ["https://arxiv.org/pdf/1706.03762", "Mistral OCR"],
+                ["https://arxiv.org/pdf/1706.03762", "Mistral OCR", True],
             ],
-            inputs=[url_input, ocr_method_url],
+            inputs=[url_input, ocr_method_url, embed_images_url],
             outputs=[url_output, url_raw_output],
             fn=perform_ocr_url
         )
 
         url_button.click(
             fn=perform_ocr_url,
-            inputs=[url_input, ocr_method_url],
+            inputs=[url_input, ocr_method_url, embed_images_url],
             outputs=[url_output, url_raw_output]
         )
 
+# Queue events so several OCR requests can run at once
+demo.queue(default_concurrency_limit=CONCURRENCY_LIMIT)
+
+# ASGI app for `uvicorn mistral_ocr_app:app`; the queue lives in process memory,
+# so run one worker per instance and use sticky sessions across instances
+app = gr.mount_gradio_app(FastAPI(), demo, path="/")
+
 # Launch the application
-demo.launch(max_threads=1)
+if __name__ == "__main__":
+    demo.launch()
@@ -0,0 +1,154 @@
+"""Pure-Python OCR helpers, kept free of Gradio so they can be compiled with mypyc."""
+import io
+import mmap
+import os
+import re
+from typing import Any
+
+try:
+    # SIMD-accelerated codec (SSSE3/AVX2/AVX-512), selected at runtime
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode  # type: ignore[assignment]
+
+try:
+    # SIMD-accelerated hash, used to key the OCR result cache
+    from blake3 import blake3 as file_hasher
+except ImportError:
+    from hashlib import blake2b as file_hasher  # type: ignore[assignment]
+
+# Constants
+MAX_FILE_SIZE_MB = 50
+# Image placeholder as emitted by Mistral: ![name](name)
+IMAGE_PLACEHOLDER = re.compile(r"!\[([^\]]+)\]\(\1\)")
+# Read size when hashing files
+HASH_CHUNK_SIZE = 1 << 20
+# Chunk size for base64 encoding; a multiple of 3 so no chunk is padded
+B64_CHUNK_SIZE = 57 * 1024
+# Mime types for documents and images, keyed on lowercase suffix
+MIME_TYPES = {
+    ".pdf": "application/pdf",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".gif": "image/gif",
+}
+
+
+def replace_images_in_markdown(markdown_str: str,
+                               images_dict: dict[str, str | None]) -> str:
+    """Replaces image placeholders in Markdown with base64 data URIs."""
+    # Images requested without base64 data keep their placeholders
+    embedded = {img_name: base64_str for img_name,
+                base64_str in images_dict.items() if base64_str}
+    if not embedded:
+        return markdown_str
+
+    # Resolve each image's data URI prefix once, not per placeholder
+    prefixes = {}
+    for img_name, base64_str in embedded.items():
+        # Ensure the base64 string is formatted correctly for Markdown image data URI
+        if base64_str.startswith('data:image'):
+            prefixes[img_name] = ""
+        else:
+            # Infer mime type from the suffix - default to png if unknown
+            mime_type = MIME_TYPES.get(
+                os.path.splitext(img_name)[1].lower(), "image/png")
+            prefixes[img_name] = f"data:{mime_type};base64,"
+
+    # Match every placeholder in a single scan of the Markdown, writing pieces
+    # straight to the buffer so each base64 payload is copied once
+    output = io.StringIO()
+    pos = 0
+    for match in IMAGE_PLACEHOLDER.finditer(markdown_str):
+        img_name = match.group(1)
+        if img_name not in embedded:
+            continue
+        output.write(markdown_str[pos:match.start()])
+        output.write(f"![{img_name}](")
+        output.write(prefixes[img_name])
+        output.write(embedded[img_name])
+        output.write(")")
+        pos = match.end()
+    output.write(markdown_str[pos:])
+    return output.getvalue()
+
+
+def file_to_data_uri(file_path: str, mime_type: str) -> str:
+    """Base64-encodes a file into a data URI, reading it through a memory map."""
+    header = f"data:{mime_type};base64,".encode('ascii')
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # mmap cannot map an empty file
+            return header.decode('ascii')
+        # Encode straight from the page cache instead of copying the file
+        # into the Python heap first
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            file_size = len(mm)
+            # Pre-size the output buffer so chunks are written in place
+            out = bytearray(len(header) + 4 * ((file_size + 2) // 3))
+            with memoryview(mm) as view, memoryview(out) as out_view:
+                out_view[:len(header)] = header
+                pos = len(header)
+                for start in range(0, file_size, B64_CHUNK_SIZE):
+                    encoded = b64encode(view[start:start + B64_CHUNK_SIZE])
+                    out_view[pos:pos + len(encoded)] = encoded
+                    pos += len(encoded)
+    return out.decode('ascii')
+
+
+def file_digest(file_path: str) -> bytes:
+    """Hash a file's contents in chunks, for use as a cache key."""
+    hasher = file_hasher()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            hasher.update(chunk)
+    return hasher.digest()
+
+
+def get_combined_markdown(ocr_response: Any,
+                          embed_images: bool = True) -> tuple[str, str] | None:
+    """Combines Markdown from OCR pages/response, optionally embedding images.
+
+    Returns None if the response has neither pages nor Markdown.
+    """
+    # Check if ocr_response has pages (for multi-page docs like PDF)
+    if hasattr(ocr_response, 'pages') and ocr_response.pages:
+        pages = ocr_response.pages
+    # Check if ocr_response has markdown directly (single images)
+    elif hasattr(ocr_response, 'markdown'):
+        pages = [ocr_response]
+    else:
+        # Handle unexpected response structure
+        print("Warning: Unexpected OCR response structure:", ocr_response)
+        return None
+
+    if not embed_images:
+        # Nothing to substitute, so the rendered Markdown is the raw Markdown
+        raw_markdown = "\n\n".join(page.markdown for page in pages)
+        return raw_markdown, raw_markdown
+
+    # Build both outputs in a single pass over the pages
+    rendered = io.StringIO()
+    raw = io.StringIO()
+    for i, page in enumerate(pages):
+        if i:
+            rendered.write("\n\n")
+            raw.write("\n\n")
+        # Assumes images are already base64 encoded by Mistral
+        image_data: dict[str, str | None] = {
+            img.id: img.image_base64 for img in getattr(page, 'images', None) or ()}
+        rendered.write(replace_images_in_markdown(page.markdown, image_data))
+        raw.write(page.markdown)
+    return rendered.getvalue(), raw.getvalue()
+
+
+def check_file_size(file_path: str) -> tuple[bool, float | str]:
+    """Check if file size is within limits."""
+    try:
+        file_size_mb = os.stat(file_path).st_size / (1024 * 1024)
+        return file_size_mb <= MAX_FILE_SIZE_MB, file_size_mb
+    except FileNotFoundError:
+        return False, "File not found"
+    except Exception as e:
+        return False, f"Error checking file size: {e}"